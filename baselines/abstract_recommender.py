@@ -12,28 +12,16 @@ recbole.model.abstract_recommender
 ##################################
 """
 
+from concurrent.futures import ThreadPoolExecutor
 from logging import getLogger
 
 import numpy as np
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 
 from recbole.model.layers import FMEmbedding, FMFirstOrderLinear
 from recbole.utils import ModelType, InputType, FeatureSource, FeatureType, set_color
-from sklearn.manifold import TSNE
-from sklearn.datasets import load_iris, load_digits
-from sklearn.decomposition import PCA
-import matplotlib.pyplot as plt
-import os, math
-from collections import defaultdict
-import torch.nn.functional as F
-import math
-from sklearn.manifold import TSNE
-from sklearn.datasets import load_iris, load_digits
-from sklearn.decomposition import PCA
-import matplotlib.pyplot as plt
-import numpy as np
-from sklearn.metrics import roc_auc_score
 
 
 class AbstractRecommender(nn.Module):
@@ -100,8 +88,7 @@ class AbstractRecommender(nn.Module):
         """
         Model prints with number of trainable parameters
         """
-        model_parameters = filter(lambda p: p.requires_grad, self.parameters())
-        params = sum([np.prod(p.size()) for p in model_parameters])
+        params = sum(p.numel() for p in self.parameters() if p.requires_grad)
         return super().__str__() + set_color('\nTrainable parameters', 'blue') + f': {params}'
 
 
@@ -131,13 +118,12 @@ class BinaryClassifier(nn.Module):
         self.fc1 = nn.Linear(input_size, hidden_size)
         self.relu = nn.ReLU()
         self.fc2 = nn.Linear(hidden_size, 1)
-        self.sigmoid = nn.Sigmoid()
 
     def forward(self, x):
+        # returns logits, the sigmoid is fused into the loss
         x = self.fc1(x)
         x = self.relu(x)
         x = self.fc2(x)
-        x = self.sigmoid(x)
         return x
 
 class SequentialRecommender(AbstractRecommender):
@@ -164,76 +150,128 @@ class SequentialRecommender(AbstractRecommender):
         self.pop_label = []
         self.name = config["model"]
         self.item_cnt = dataset.counter(dataset.iid_field)
+        item_cnt_arr = np.zeros(self.n_items, dtype=np.int64)
+        for item_k, v in self.item_cnt.items():
+            item_cnt_arr[item_k] = v
+        self.item_cnt_arr = np.maximum(item_cnt_arr, 1)
         self.label_strategy = config['label']
         self.label_count = config['lcnt']
         self.epoch = 0
         self.vis = config['vis']
         self.prefix = config['exp']
+        self.vis_executor = None
+        self.vis_future = None
+        self.register_buffer(
+            'causal_mask',
+            torch.tril(torch.ones(self.max_seq_length, self.max_seq_length, dtype=torch.bool)).view(
+                1, 1, self.max_seq_length, self.max_seq_length
+            ),
+            persistent=False
+        )
+        if config['compile']:
+            # fuse the elementwise chain of the attention mask into a single kernel
+            self.get_attention_mask = torch.compile(self.get_attention_mask, dynamic=True)
         self.cal_popular()
-        # for item_k in range(self.n_items):
-        #     v = self.item_cnt[item_k]
-        #     v = max(v, 1)
-        #     nv = round(math.log(v))
-        #     self.label.append(nv)
-        # print("max label", max(self.label))
 
 
     def cal_popular(self):
-        label = []
-        for item_k in range(self.n_items):
-            v = self.item_cnt[item_k]
-            v = max(v, 1)
-            label.append(v)
-
-        max_pop = max(label)
-        self.label = []
-        lidx = np.argsort(label)
-
-
-        for i, v in enumerate(label):
-            nv = round(math.log(v))
-            if self.label_strategy == 'avg':
-                nv = round(self.label_count * v / max_pop)
-            elif self.label_strategy == 'arg':
-                nv = round(self.label_count * lidx[i]/len(lidx))
-            self.label.append(nv)
+        counts = self.item_cnt_arr
+
+        if self.label_strategy == 'avg':
+            labels = np.rint(self.label_count * counts / counts.max())
+        elif self.label_strategy == 'arg':
+            # rank of each item in ascending popularity order
+            lidx = np.argsort(counts)
+            rank = np.empty_like(lidx)
+            rank[lidx] = np.arange(len(lidx))
+            labels = np.rint(self.label_count * rank / len(lidx))
+        else:
+            labels = np.rint(np.log(counts))
+        self.label = labels.astype(np.int32)
+        # device copy for the popularity reductions, moved along with the model
+        self.register_buffer('label_buf', torch.from_numpy(self.label).long(), persistent=False)
 
-        print("max label", max(self.label), 'count', len(self.label))
+        print("max label", int(self.label.max()), 'count', len(self.label))
 
 
     def cal_curr_pop(self, scores):
-        pop_label = []
-        for i in scores.topk(10)[1]:
-            mypop = 0
-            for j in i:
-                mypop += self.label[j]
-            pop_label.append(mypop)
+        topk_idx = scores.topk(10)[1]  # [B 10]
+        pop_label = self.label_buf[topk_idx].sum(dim=1)  # [B]
 
-        pop = sum(pop_label)/10/len(pop_label)
-        print('popular rate', pop, 'max', max(self.label), 'count', len(pop_label))
+        pop = pop_label.float().mean().item() / 10
+        print('popular rate', pop, 'max', int(self.label.max()), 'count', pop_label.size(0))
 
 
     def vis_emb(self, emb, epoch, labels=None, exp="pop"):
-        x_in = emb.detach().cpu().numpy()
-        epoch = "{0:03d}".format(epoch)
-        X_tsne = TSNE(n_components=2, random_state=33).fit_transform(x_in)
-        plt.figure(figsize=(10, 10))
+        emb = emb.detach()
         if labels is None:
             labels = self.label
-        plt.scatter(
+        # t-SNE and plotting run in the background so that training is not blocked
+        if self.vis_executor is None:
+            self.vis_executor = ThreadPoolExecutor(max_workers=1)
+        if self.vis_future is not None:
+            # let the previous projection finish so that jobs cannot pile up, its errors are logged by the callback
+            self.vis_future.exception()
+        try:
+            from cuml.manifold import TSNE as CUTSNE
+        except ImportError:
+            CUTSNE = None
+        if CUTSNE is not None and emb.is_cuda:
+            # project on device, only the [N 2] result is copied back to host
+            x_in = emb.float().contiguous()
+            cu_tsne = CUTSNE(n_components=2, method='fft', random_state=33, output_type='numpy')
+            self.vis_future = self.vis_executor.submit(lambda: self.plot_emb(cu_tsne.fit_transform(x_in), epoch, labels, exp))
+        else:
+            x_in = emb.cpu().float().numpy()
+            self.vis_future = self.vis_executor.submit(lambda: self.plot_emb(self.tsne_emb(x_in), epoch, labels, exp))
+        self.vis_future.add_done_callback(self.log_vis_error)
+
+    def log_vis_error(self, future):
+        exception = future.exception()
+        if exception is not None:
+            self.logger.error('vis_emb failed', exc_info=exception)
+
+    def tsne_emb(self, x_in):
+        from sklearn.decomposition import PCA
+        from sklearn.manifold import TSNE
+
+        if x_in.shape[1] > 50:
+            x_in = PCA(n_components=50).fit_transform(x_in)
+        try:
+            from openTSNE import TSNE as OTSNE
+        except ImportError:
+            OTSNE = None
+        if OTSNE is not None:
+            return np.asarray(
+                OTSNE(n_components=2, n_jobs=-1, negative_gradient_method='fft', random_state=33).fit(x_in)
+            )
+        return TSNE(n_components=2, random_state=33).fit_transform(x_in)
+
+    def plot_emb(self, X_tsne, epoch, labels, exp):
+        from matplotlib.figure import Figure
+
+        epoch = "{0:03d}".format(epoch)
+        # pyplot keeps global state, so draw on a standalone figure from the worker thread
+        fig = Figure(figsize=(10, 10))
+        ax = fig.add_subplot()
+        ax.scatter(
             X_tsne[:, 0], X_tsne[:, 1], c=labels, label="Raw", s=15, cmap="coolwarm"
         )
-        plt.legend()
-        plt.savefig("./images/" + self.name + "_t_" + exp + "_"+ epoch + ".png", dpi=120)
+        ax.legend()
+        fig.savefig("./images/" + self.name + "_t_" + exp + "_"+ epoch + ".png", dpi=120)
 
 
     def init_bias_layer(self):
         self.item_bias_layer = BinaryClassifier(self.hidden_size, self.hidden_size)
+        self.bloss = nn.BCEWithLogitsLoss()
 
 
     def predict_bias(self):
+        from sklearn.metrics import roc_auc_score
+
         test_items_emb = self.item_embedding.weight
         bias_score = self.item_bias_layer(test_items_emb)
+        # AUC only depends on the ranking, so the logits are used without a sigmoid
         score = bias_score.squeeze()[self.bias_idx].detach().cpu().numpy()
         label = self.bias_label.detach().cpu().numpy()
         auc = roc_auc_score(label, score)
@@ -248,32 +286,18 @@ class SequentialRecommender(AbstractRecommender):
         return bias_loss
 
     def calcualte_bias_label(self):
-        bias = []
-        for item_k in range(self.n_items):
-            v = self.item_cnt[item_k]
-            v = max(v, 1)
-            bias.append(v)
-        bias_bak = bias[:]
-        bias_bak.sort()
-        mid_i = int(len(bias_bak) * self.b_ratio)
-        bias_line = bias_bak[-mid_i]
-        nobias_line = bias_bak[mid_i]
-        self.bias_label = []
-        self.bias_idx = []
-        bias_cnt, nobias_cnt = 0, 0
-        for i, v in enumerate(bias):
-            if v >= bias_line:
-                self.bias_label.append(1)
-                self.bias_idx.append(i)
-                bias_cnt += 1
-            elif v <= nobias_line:
-                if mid_i < nobias_cnt:
-                    continue
-                self.bias_label.append(0)
-                self.bias_idx.append(i)
-                nobias_cnt += 1
-
-        self.bias_label = torch.tensor(self.bias_label, requires_grad=True, dtype=torch.float32).to(self.device)
+        bias = self.item_cnt_arr
+        mid_i = int(self.n_items * self.b_ratio)
+        bias_line = np.partition(bias, -mid_i)[-mid_i]
+        nobias_line = np.partition(bias, mid_i)[mid_i]
+
+        bias_idx = np.flatnonzero(bias >= bias_line)
+        # at most mid_i + 1 non-bias items are kept, in item id order
+        nobias_idx = np.flatnonzero((bias < bias_line) & (bias <= nobias_line))[:mid_i + 1]
+        bias_cnt, nobias_cnt = len(bias_idx), len(nobias_idx)
+
+        self.bias_idx = torch.from_numpy(np.concatenate([bias_idx, nobias_idx])).to(self.device)
+        self.bias_label = torch.cat([torch.ones(bias_cnt), torch.zeros(nobias_cnt)]).to(self.device).requires_grad_()
 
         print("bias value", bias_line, "count", bias_cnt, ", non bias value", nobias_line, "count", nobias_cnt)
 
@@ -282,29 +306,24 @@ class SequentialRecommender(AbstractRecommender):
 
     def run_per_epoch(self, epoch):
         if self.vis and epoch % 2 == 0:
-            test_item_emb = self.moe_adaptor(self.plm_embedding.weight)
+            # visualization only, the projection does not need fp32 or autograd
+            with torch.no_grad(), torch.autocast(self.plm_embedding.weight.device.type, dtype=torch.bfloat16):
+                test_item_emb = self.moe_adaptor(self.plm_embedding.weight)
             self.vis_emb(test_item_emb, epoch, exp=self.prefix+"_pop")
 
     def gather_indexes(self, output, gather_index):
         """Gathers the vectors at the specific positions over a minibatch"""
-        gather_index = gather_index.view(-1, 1, 1).expand(-1, -1, output.shape[-1])
-        output_tensor = output.gather(dim=1, index=gather_index)
-        return output_tensor.squeeze(1)
+        batch_index = torch.arange(output.size(0), device=output.device)
+        return output[batch_index, gather_index]  # [B H]
 
     def get_attention_mask(self, item_seq):
         """Generate left-to-right uni-directional attention mask for multi-head attention."""
-        attention_mask = (item_seq > 0).long()
-        extended_attention_mask = attention_mask.unsqueeze(1).unsqueeze(2)  # torch.int64
+        max_len = item_seq.size(-1)
+        attention_mask = (item_seq > 0).unsqueeze(1).unsqueeze(2)  # torch.bool
         # mask for left-to-right unidirectional
-        max_len = attention_mask.size(-1)
-        attn_shape = (1, max_len, max_len)
-        subsequent_mask = torch.triu(torch.ones(attn_shape), diagonal=1)  # torch.uint8
-        subsequent_mask = (subsequent_mask == 0).unsqueeze(1)
-        subsequent_mask = subsequent_mask.long().to(item_seq.device)
-
-        extended_attention_mask = extended_attention_mask * subsequent_mask
-        extended_attention_mask = extended_attention_mask.to(dtype=next(self.parameters()).dtype)  # fp16 compatibility
-        extended_attention_mask = (1.0 - extended_attention_mask) * -10000.0
+        extended_attention_mask = attention_mask & self.causal_mask[:, :, :max_len, :max_len]
+        extended_attention_mask = (~extended_attention_mask).to(dtype=next(self.parameters()).dtype)  # fp16 compatibility
+        extended_attention_mask = extended_attention_mask * -10000.0
         return extended_attention_mask
 
 class KnowledgeRecommender(AbstractRecommender):
@@ -407,7 +426,7 @@ class ContextRecommender(AbstractRecommender):
                 self.float_field_dims.append(dataset.num(field_name))
             self.num_feature_field += 1
         if len(self.token_field_dims) > 0:
-            self.token_field_offsets = np.array((0, *np.cumsum(self.token_field_dims)[:-1]), dtype=np.long)
+            self.token_field_offsets = np.concatenate(([0], np.cumsum(self.token_field_dims)[:-1])).astype(np.int64)
             self.token_embedding_table = FMEmbedding(
                 self.token_field_dims, self.token_field_offsets, self.embedding_size
             )
@@ -415,10 +434,21 @@ class ContextRecommender(AbstractRecommender):
             self.float_embedding_table = nn.Embedding(
                 np.sum(self.float_field_dims, dtype=np.int32), self.embedding_size
             )
+            self.register_buffer(
+                'float_field_index',
+                torch.arange(np.sum(self.float_field_dims, dtype=np.int32), dtype=torch.long).unsqueeze(0),
+                persistent=False
+            )
         if len(self.token_seq_field_dims) > 0:
-            self.token_seq_embedding_table = nn.ModuleList()
-            for token_seq_field_dim in self.token_seq_field_dims:
-                self.token_seq_embedding_table.append(nn.Embedding(token_seq_field_dim, self.embedding_size))
+            # all token sequence fields share one table, each field owning a slice of rows
+            self.token_seq_embedding_table = nn.Embedding(
+                np.sum(self.token_seq_field_dims, dtype=np.int32), self.embedding_size
+            )
+            self.register_buffer(
+                'token_seq_field_offsets',
+                torch.from_numpy(np.concatenate(([0], np.cumsum(self.token_seq_field_dims)[:-1])).astype(np.int64)),
+                persistent=False
+            )
 
         self.first_order_linear = FMFirstOrderLinear(config, dataset)
 
@@ -436,13 +466,15 @@ class ContextRecommender(AbstractRecommender):
         if not embed or float_fields is None:
             return float_fields
 
-        num_float_field = float_fields.shape[1]
         # [batch_size, num_float_field]
-        index = torch.arange(0, num_float_field).unsqueeze(0).expand_as(float_fields).long().to(self.device)
+        index = self.float_field_index.expand_as(float_fields)
 
         # [batch_size, num_float_field, embed_dim]
         float_embedding = self.float_embedding_table(index)
-        float_embedding = torch.mul(float_embedding, float_fields.unsqueeze(2))
+        if float_fields.requires_grad:
+            float_embedding = torch.mul(float_embedding, float_fields.unsqueeze(2))
+        else:
+            float_embedding.mul_(float_fields.unsqueeze(2))
 
         return float_embedding
 
@@ -467,40 +499,48 @@ class ContextRecommender(AbstractRecommender):
         """Embed the token feature columns
 
         Args:
-            token_seq_fields (torch.LongTensor): The input tensor. shape of [batch_size, seq_len]
+            token_seq_fields (list of torch.LongTensor): The input tensors. shape of [batch_size, seq_len]
             mode (str): How to aggregate the embedding of feature in this field. default=mean
 
         Returns:
             torch.FloatTensor: The result embedding tensor of token sequence columns.
         """
         # input is a list of Tensor shape of [batch_size, seq_len]
-        fields_result = []
-        for i, token_seq_field in enumerate(token_seq_fields):
-            embedding_table = self.token_seq_embedding_table[i]
-            mask = token_seq_field != 0  # [batch_size, seq_len]
-            mask = mask.float()
-            value_cnt = torch.sum(mask, dim=1, keepdim=True)  # [batch_size, 1]
-
-            token_seq_embedding = embedding_table(token_seq_field)  # [batch_size, seq_len, embed_dim]
-
-            mask = mask.unsqueeze(2).expand_as(token_seq_embedding)  # [batch_size, seq_len, embed_dim]
-            if mode == 'max':
-                masked_token_seq_embedding = token_seq_embedding - (1 - mask) * 1e9  # [batch_size, seq_len, embed_dim]
-                result = torch.max(masked_token_seq_embedding, dim=1, keepdim=True)  # [batch_size, 1, embed_dim]
-            elif mode == 'sum':
-                masked_token_seq_embedding = token_seq_embedding * mask.float()
-                result = torch.sum(masked_token_seq_embedding, dim=1, keepdim=True)  # [batch_size, 1, embed_dim]
-            else:
-                masked_token_seq_embedding = token_seq_embedding * mask.float()
-                result = torch.sum(masked_token_seq_embedding, dim=1)  # [batch_size, embed_dim]
-                eps = torch.FloatTensor([1e-8]).to(self.device)
-                result = torch.div(result, value_cnt + eps)  # [batch_size, embed_dim]
-                result = result.unsqueeze(1)  # [batch_size, 1, embed_dim]
-            fields_result.append(result)
-        if len(fields_result) == 0:
+        if len(token_seq_fields) == 0:
             return None
+        max_len = max(token_seq_field.size(1) for token_seq_field in token_seq_fields)
+        token_seq_field = torch.stack([
+            F.pad(token_seq_field, (0, max_len - token_seq_field.size(1))) for token_seq_field in token_seq_fields
+        ], dim=1)  # [batch_size, num_token_seq_field, seq_len]
+
+        # shift each field into its slice of the shared table, padding becomes -1
+        token_seq_ids = torch.where(
+            token_seq_field != 0, token_seq_field + self.token_seq_field_offsets.view(1, -1, 1), -1
+        ).view(-1, max_len)  # [batch_size * num_token_seq_field, seq_len]
+
+        # repeated rows are embedded and pooled only once, unless there are too few repeats to pay off
+        uniq_ids, inverse = torch.unique(token_seq_ids, dim=0, return_inverse=True)
+        if uniq_ids.size(0) <= 0.8 * token_seq_ids.size(0):
+            token_seq_ids = uniq_ids
+        else:
+            inverse = None
+
+        mask = token_seq_ids >= 0  # [num_rows, seq_len]
+        token_seq_embedding = self.token_seq_embedding_table(token_seq_ids.clamp_min(0))  # [num_rows, seq_len, embed_dim]
+
+        if mode == 'max':
+            masked_token_seq_embedding = token_seq_embedding.masked_fill(~mask.unsqueeze(2), -1e9)
+            result = torch.max(masked_token_seq_embedding, dim=1).values  # [num_rows, embed_dim]
         else:
-            return torch.cat(fields_result, dim=1)  # [batch_size, num_token_seq_field, embed_dim]
+            mask = mask.to(token_seq_embedding.dtype)
+            result = torch.einsum('rl,rld->rd', mask, token_seq_embedding)  # [num_rows, embed_dim]
+            if mode != 'sum':
+                value_cnt = mask.sum(dim=1, keepdim=True).clamp_min_(1e-8)  # [num_rows, 1]
+                result = result / value_cnt
+        if inverse is not None:
+            result = result[inverse]
+        result = result.view(-1, len(token_seq_fields), self.embedding_size)
+        return result  # [batch_size, num_token_seq_field, embed_dim]
 
     def double_tower_embed_input_fields(self, interaction):
         """Embed the whole feature columns in a double tower way.
@@ -557,32 +597,26 @@ class ContextRecommender(AbstractRecommender):
             torch.FloatTensor: The embedding tensor of token sequence columns.
             torch.FloatTensor: The embedding tensor of float sequence columns.
         """
-        float_fields = []
-        for field_name in self.float_field_names:
-            if len(interaction[field_name].shape) == 2:
-                float_fields.append(interaction[field_name])
-            else:
-                float_fields.append(interaction[field_name].unsqueeze(1))
-        if len(float_fields) > 0:
-            float_fields = torch.cat(float_fields, dim=1)  # [batch_size, num_float_field]
+        if len(self.float_field_names) > 0:
+            # 1-D fields become a single column, 2-D fields keep their columns
+            float_fields = torch.cat([
+                interaction[field_name].view(interaction[field_name].size(0), -1)
+                for field_name in self.float_field_names
+            ], dim=1)  # [batch_size, num_float_field]
         else:
             float_fields = None
         # [batch_size, num_float_field] or [batch_size, num_float_field, embed_dim] or None
         float_fields_embedding = self.embed_float_fields(float_fields)
 
-        token_fields = []
-        for field_name in self.token_field_names:
-            token_fields.append(interaction[field_name].unsqueeze(1))
-        if len(token_fields) > 0:
-            token_fields = torch.cat(token_fields, dim=1)  # [batch_size, num_token_field]
+        if len(self.token_field_names) > 0:
+            # [batch_size, num_token_field]
+            token_fields = torch.stack([interaction[field_name] for field_name in self.token_field_names], dim=1)
         else:
             token_fields = None
         # [batch_size, num_token_field, embed_dim] or None
         token_fields_embedding = self.embed_token_fields(token_fields)
 
-        token_seq_fields = []
-        for field_name in self.token_seq_field_names:
-            token_seq_fields.append(interaction[field_name])
+        token_seq_fields = [interaction[field_name] for field_name in self.token_seq_field_names]
         # [batch_size, num_token_seq_field, embed_dim] or None
         token_seq_fields_embedding = self.embed_token_seq_fields(token_seq_fields)
 
@@ -17,12 +17,55 @@ Reference:
 
 import torch
 from torch import nn
+import torch.nn.functional as F
 
-from recbole.model.abstract_recommender import SequentialRecommender
 from baselines.abstract_recommender import SequentialRecommender
-from recbole.model.layers import TransformerEncoder
+from recbole.model.layers import TransformerEncoder, MultiHeadAttention
 from recbole.model.loss import BPRLoss
-import math
+
+
+def quantize_per_row_int8(x, row_multiple=1):
+    """Symmetric per-row int8 quantization of a 2-D tensor.
+
+    Returns the int8 tensor, zero padded to a multiple of 8 columns and ``row_multiple`` rows
+    as ``torch._int_mm`` requires, and the fp32 scale of every original row.
+    """
+    scales = x.abs().amax(dim=1).clamp_min(1e-8) / 127.0  # [rows]
+    q = torch.round(x / scales.unsqueeze(1)).clamp_(-127, 127).to(torch.int8)
+    q = F.pad(q, (0, -q.size(1) % 8, 0, -q.size(0) % row_multiple))
+    return q, scales
+
+
+class SDPAMultiHeadAttention(MultiHeadAttention):
+    """RecBole multi-head attention computed with ``F.scaled_dot_product_attention``.
+
+    With ``attention_mask=None`` the causal mask is applied inside the kernel, which lets PyTorch
+    dispatch to FlashAttention instead of materializing the [B, n_heads, L, L] scores. For right padded
+    sequences this is exact at every non-padding position, so the padding mask is not needed.
+    An explicit additive mask is still honored, at the cost of the fused causal path.
+    """
+
+    def forward(self, input_tensor, attention_mask):
+        batch_size, seq_len, _ = input_tensor.size()
+
+        def split_heads(x):
+            return x.view(batch_size, seq_len, self.num_attention_heads, self.attention_head_size).transpose(1, 2)
+
+        query_layer = split_heads(self.query(input_tensor))
+        key_layer = split_heads(self.key(input_tensor))
+        value_layer = split_heads(self.value(input_tensor))
+
+        context_layer = F.scaled_dot_product_attention(
+            query_layer, key_layer, value_layer, attn_mask=attention_mask,
+            dropout_p=self.attn_dropout.p if self.training else 0.0, is_causal=attention_mask is None
+        )  # [B n_heads L head_size]
+        context_layer = context_layer.transpose(1, 2).reshape(batch_size, seq_len, self.all_head_size)
+
+        hidden_states = self.dense(context_layer)
+        hidden_states = self.out_dropout(hidden_states)
+        hidden_states = self.LayerNorm(hidden_states + input_tensor)
+        return hidden_states
+
 
 class SASRecN(SequentialRecommender):
     r"""
@@ -57,6 +100,9 @@ class SASRecN(SequentialRecommender):
             self.n_items, self.hidden_size, padding_idx=0
         )
         self.position_embedding = nn.Embedding(self.max_seq_length, self.hidden_size)
+        self.register_buffer(
+            "position_ids", torch.arange(self.max_seq_length, dtype=torch.long).unsqueeze(0), persistent=False
+        )
         self.trm_encoder = TransformerEncoder(
             n_layers=self.n_layers,
             n_heads=self.n_heads,
@@ -67,19 +113,44 @@ class SASRecN(SequentialRecommender):
             hidden_act=self.hidden_act,
             layer_norm_eps=self.layer_norm_eps,
         )
+        # scaled_dot_product_attention needs torch >= 2.0, older versions keep the stock attention and mask
+        self.use_sdpa = hasattr(F, "scaled_dot_product_attention")
+        if self.use_sdpa:
+            for layer in self.trm_encoder.layer:
+                # same parameter names, only the attention computation changes. weights are set by _init_weights below
+                layer.multi_head_attention = SDPAMultiHeadAttention(
+                    self.n_heads, self.hidden_size, self.hidden_dropout_prob, self.attn_dropout_prob, self.layer_norm_eps
+                )
+        if config["compile"]:
+            # item sequences are already padded to MAX_ITEM_LIST_LENGTH, so CUDA graphs can be reused.
+            # compile forward only, wrapping the module would prefix its state_dict keys
+            self.trm_encoder.forward = torch.compile(self.trm_encoder.forward, mode="reduce-overhead")
 
         self.LayerNorm = nn.LayerNorm(self.hidden_size, eps=self.layer_norm_eps)
         self.dropout = nn.Dropout(self.hidden_dropout_prob)
-        self.fc_item = torch.nn.Linear(self.hidden_size, 1)
-        self.fc_user = torch.nn.Linear(self.hidden_size, 1)
+        if config["compile"]:
+            # lets Inductor fuse the embedding gather, the add and LayerNorm
+            self.embed_input = torch.compile(self.embed_input)
+            # fuses the subtraction and both broadcast gates into one pass over the scores
+            self.gate_scores = torch.compile(self.gate_scores, dynamic=True)
+        # opt-in, and never with a compiled encoder since CUDA graphs want static shapes
+        self.trim_padding = bool(config["trim_padding"]) and not config["compile"]
+        # single-output gates, kept as a weight vector and a bias instead of nn.Linear(hidden_size, 1)
+        self.w_item = nn.Parameter(torch.empty(self.hidden_size).normal_(mean=0.0, std=self.initializer_range))
+        self.b_item = nn.Parameter(torch.zeros(1))
+        self.w_user = nn.Parameter(torch.empty(self.hidden_size).normal_(mean=0.0, std=self.initializer_range))
+        self.b_user = nn.Parameter(torch.zeros(1))
         self.c = config['biasc']
         self.alpha = config['alpha']
+        self.bf16 = bool(config['bf16'])
+        self.int8_eval = bool(config['int8_eval'])
+        self.item_emb_int8, self.item_emb_scales = None, None
+        self.pop_label_buf = []
+        self.item_scores_cache, self.item_scores_version = None, None
 
         if self.loss_type == "BPR":
             self.loss_fct = BPRLoss()
-        elif self.loss_type == "CE":
-            self.loss_fct = nn.CrossEntropyLoss()
-        else:
+        elif self.loss_type != "CE":  # the CE losses are computed directly in calculate_loss
             raise NotImplementedError("Make sure 'loss_type' in ['BPR', 'CE']!")
 
         # parameters initialization
@@ -101,84 +172,149 @@ class SASRecN(SequentialRecommender):
         if isinstance(module, nn.Linear) and module.bias is not None:
             module.bias.data.zero_()
 
-    def forward(self, item_seq, item_seq_len):
-        position_ids = torch.arange(
-            item_seq.size(1), dtype=torch.long, device=item_seq.device
-        )
-        position_ids = position_ids.unsqueeze(0).expand_as(item_seq)
-        position_embedding = self.position_embedding(position_ids)
+    def train(self, mode=True):
+        # the item table may change between evaluations, so re-quantize it on the next full sort
+        self.item_emb_int8, self.item_emb_scales = None, None
+        self.item_scores_cache, self.item_scores_version = None, None
+        return super(SASRecN, self).train(mode)
+
+    def cal_curr_pop(self, scores):
+        if len(self.pop_label_buf) > 0:
+            self.pop_label.extend(torch.cat(self.pop_label_buf).cpu().tolist())
+            self.pop_label_buf = []
+        super(SASRecN, self).cal_curr_pop(scores)
+
+    def gate_scores(self, scores, user_score, item_scores):
+        """Shift the scores by ``c`` and scale them by the user and item gates"""
+        if torch.is_grad_enabled():
+            return (scores - self.c) * (user_score * item_scores)
+        # without autograd the fresh difference tensor can be scaled in place
+        return (scores - self.c).mul_(user_score).mul_(item_scores)
+
+    def autocast(self):
+        """bf16 autocast for the encoder and the scoring matmuls, a no-op unless ``bf16`` is set"""
+        return torch.autocast(device_type=self.device.type, dtype=torch.bfloat16, enabled=self.bf16)
+
+    def embed_input(self, item_seq):
+        """Item + position embedding followed by LayerNorm and dropout, kept together so they compile into one kernel"""
+        # [1 L H], broadcast over the batch when added to item_emb
+        position_embedding = self.position_embedding(self.position_ids[:, :item_seq.size(1)])
 
         item_emb = self.item_embedding(item_seq)
         input_emb = item_emb + position_embedding
         input_emb = self.LayerNorm(input_emb)
         input_emb = self.dropout(input_emb)
+        return input_emb
 
-        extended_attention_mask = self.get_attention_mask(item_seq)
-
+    def forward(self, item_seq, item_seq_len):
+        if self.trim_padding:
+            # sequences are right padded, so columns past the longest one only hold padding.
+            # reading the max length costs one device-to-host sync per forward
+            item_seq = item_seq[:, :int(item_seq_len.max())]
+        input_emb = self.embed_input(item_seq.contiguous())
+
+        # SDPAMultiHeadAttention applies the causal mask itself, so no attention mask is built
+        extended_attention_mask = None if self.use_sdpa else self.get_attention_mask(item_seq)
         trm_output = self.trm_encoder(
-            input_emb, extended_attention_mask, output_all_encoded_layers=True
+            input_emb, extended_attention_mask, output_all_encoded_layers=False
         )
-        output = trm_output[-1]
+        output = trm_output[-1]  # only the last layer is returned
         output = self.gather_indexes(output, item_seq_len - 1)
         return output  # [B H]
 
     def calculate_loss(self, interaction):
         item_seq = interaction[self.ITEM_SEQ]
         item_seq_len = interaction[self.ITEM_SEQ_LEN]
-        seq_output = self.forward(item_seq, item_seq_len)
+        with self.autocast():
+            seq_output = self.forward(item_seq, item_seq_len)
+        seq_output = seq_output.float()
         pos_items = interaction[self.POS_ITEM_ID]
         if self.loss_type == "BPR":
             neg_items = interaction[self.NEG_ITEM_ID]
             pos_items_emb = self.item_embedding(pos_items)
             neg_items_emb = self.item_embedding(neg_items)
-            pos_score = torch.sum(seq_output * pos_items_emb, dim=-1)  # [B]
-            neg_score = torch.sum(seq_output * neg_items_emb, dim=-1)  # [B]
+            pos_score = torch.einsum('bh,bh->b', seq_output, pos_items_emb)  # [B]
+            neg_score = torch.einsum('bh,bh->b', seq_output, neg_items_emb)  # [B]
             loss = self.loss_fct(pos_score, neg_score)
             return loss
         else:  # self.loss_type = 'CE'
             test_item_emb = self.item_embedding.weight
-            logits = torch.matmul(seq_output, test_item_emb.transpose(0, 1))
+            with self.autocast():
+                logits = torch.matmul(seq_output, test_item_emb.transpose(0, 1))
+            logits = logits.float()
 
-            user_score = torch.nn.Sigmoid()(self.fc_user(seq_output)).squeeze().unsqueeze(1)
-            item_scores = torch.nn.Sigmoid()(self.fc_item(test_item_emb)).squeeze().unsqueeze(0)
-            logits = logits * user_score * item_scores - self.c * user_score * item_scores
+            user_logit = seq_output @ self.w_user + self.b_user  # [B]
+            user_score = torch.sigmoid(user_logit).reshape(-1, 1)  # [B 1]
+            item_scores = torch.sigmoid(test_item_emb @ self.w_item + self.b_item).reshape(1, -1)  # [1 n_items]
+            logits = self.gate_scores(logits, user_score, item_scores)
 
-            pos_labels, neg_labels = torch.ones_like(user_score), torch.zeros_like(user_score)
+            pos_labels, neg_labels = torch.ones_like(user_logit), torch.zeros_like(user_logit)
 
-            L_u = torch.nn.BCELoss()(user_score, pos_labels) + torch.nn.BCELoss()(user_score, neg_labels)
-            L_i = self.loss_fct(item_scores.repeat(pos_items.size(0), 1), pos_items)
+            L_u = F.binary_cross_entropy_with_logits(user_logit, pos_labels) + \
+                F.binary_cross_entropy_with_logits(user_logit, neg_labels)
+            # every row of the repeated item_scores is identical, so CE reduces to a gather on one log_softmax
+            L_i = -F.log_softmax(item_scores.squeeze(0), dim=-1)[pos_items].mean()
 
-            loss = self.loss_fct(logits, pos_items)
+            # cross entropy as one logsumexp pass minus the gathered target logits
+            loss = (torch.logsumexp(logits, dim=-1) - logits.gather(1, pos_items.view(-1, 1)).squeeze(1)).mean()
             return loss, self.alpha * L_u, self.alpha * L_i
 
     def predict(self, interaction):
         item_seq = interaction[self.ITEM_SEQ]
         item_seq_len = interaction[self.ITEM_SEQ_LEN]
         test_item = interaction[self.ITEM_ID]
-        seq_output = self.forward(item_seq, item_seq_len)
+        with self.autocast():
+            seq_output = self.forward(item_seq, item_seq_len)
+        seq_output = seq_output.float()
         test_item_emb = self.item_embedding(test_item)
         scores = torch.mul(seq_output, test_item_emb).sum(dim=1)  # [B]
 
-        user_score = torch.nn.Sigmoid()(self.fc_user(seq_output)).squeeze().unsqueeze(1)
-        item_scores = torch.nn.Sigmoid()(self.fc_item(test_item_emb)).squeeze().unsqueeze(0)
-        scores = scores * user_score * item_scores - self.c * user_score * item_scores
+        # one test item per sequence, so both gates are [B] and apply elementwise
+        user_score = torch.sigmoid(seq_output @ self.w_user + self.b_user)  # [B]
+        item_scores = torch.sigmoid(test_item_emb @ self.w_item + self.b_item)  # [B]
+        scores = self.gate_scores(scores, user_score, item_scores)
 
         return scores
 
+    @torch.no_grad()
+    def full_sort_item_scores(self):
+        """The item gate of every item as [1 n_items], cached until one of its weights is updated"""
+        version = (self.item_embedding.weight._version, self.w_item._version, self.b_item._version)
+        if self.item_scores_cache is None or self.item_scores_version != version:
+            self.item_scores_cache = torch.sigmoid(self.item_embedding.weight @ self.w_item + self.b_item).reshape(1, -1)
+            self.item_scores_version = version
+        return self.item_scores_cache
+
+    def int8_full_sort_matmul(self, seq_output):
+        """[B H] x [n_items H]^T computed with int8 operands, the item table is quantized once per evaluation"""
+        if self.item_emb_int8 is None:
+            self.item_emb_int8, self.item_emb_scales = quantize_per_row_int8(
+                self.item_embedding.weight.detach().float(), row_multiple=8
+            )
+        seq_int8, seq_scales = quantize_per_row_int8(seq_output.detach().float())
+        scores = torch._int_mm(seq_int8, self.item_emb_int8.t())[:, :self.n_items]  # [B n_items] int32
+        return scores.float().mul_(seq_scales.unsqueeze(1)).mul_(self.item_emb_scales.unsqueeze(0))
+
     def full_sort_predict(self, interaction):
         item_seq = interaction[self.ITEM_SEQ]
         item_seq_len = interaction[self.ITEM_SEQ_LEN]
-        seq_output = self.forward(item_seq, item_seq_len)
         test_items_emb = self.item_embedding.weight
-        scores = torch.matmul(seq_output, test_items_emb.transpose(0, 1))  # [B n_items]
+        with self.autocast():
+            seq_output = self.forward(item_seq, item_seq_len)
+        seq_output = seq_output.float()
+        # torch._int_mm only runs on CUDA and needs more than 16 rows
+        if self.int8_eval and seq_output.is_cuda and seq_output.size(0) > 16:
+            scores = self.int8_full_sort_matmul(seq_output)  # [B n_items]
+        else:
+            with self.autocast():
+                scores = torch.matmul(seq_output, test_items_emb.transpose(0, 1))  # [B n_items]
+            scores = scores.float()
 
-        user_score = torch.nn.Sigmoid()(self.fc_user(seq_output)).squeeze().unsqueeze(1)
-        item_scores = torch.nn.Sigmoid()(self.fc_item(test_items_emb)).squeeze().unsqueeze(0)
-        scores = scores * user_score * item_scores - self.c * user_score * item_scores
+        user_score = torch.sigmoid(seq_output @ self.w_user + self.b_user).reshape(-1, 1)  # [B 1]
+        item_scores = self.full_sort_item_scores()  # [1 n_items]
+        scores = self.gate_scores(scores, user_score, item_scores)
 
-        for i in scores.topk(10)[1]:
-            mypop = 0
-            for j in i:
-                mypop += self.label[j]
-            self.pop_label.append(mypop)
+        mypop = self.label_buf[scores.topk(10)[1]].sum(dim=1)  # [B]
+        # kept on device, copied into pop_label once at the end of the evaluation
+        self.pop_label_buf.append(mypop)
         return scores
@@ -87,7 +87,6 @@ class UniSRecB(SASRec):
             config['adaptor_dropout_prob']
         )
 
-        self.bloss = nn.BCELoss()
         self.init_bias_layer()
         self.epoch = 0
         self.last_bloss = 0